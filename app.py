@@ -2,9 +2,24 @@
 Streamlit Frontend for Multi-University RAG System
 """
 
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
 import streamlit as st
+import streamlit.components.v1 as components
 from backend import process_query
 
+# Identical submissions closer together than this are treated as a double-click
+DUPLICATE_SUBMIT_WINDOW = 0.5
+
+# Sessions are persisted here so a refresh/restart resumes the chat
+SESSIONS_DIR = os.path.join("data", "sessions")
+SESSION_MAX_TURNS = 10
+SESSION_COOKIE_MAX_AGE = 30 * 24 * 3600
+
 # ==================== PAGE CONFIGURATION ====================
 st.set_page_config(
     page_title="University Assistant",
@@ -13,45 +28,69 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# ==================== CUSTOM CSS ====================
-st.markdown("""
-    <style>
-    .main {
-        background-color: #f5f7fa;
-    }
-    .stTextInput > div > div > input {
-        border-radius: 20px;
-    }
-    .chat-message {
-        padding: 1.5rem;
-        border-radius: 10px;
-        margin-bottom: 1rem;
-        display: flex;
-        flex-direction: column;
-    }
-    .user-message {
-        background-color: #e3f2fd;
-        border-left: 5px solid #2196F3;
-        color: #000000;
-    }
-    .assistant-message {
-        background-color: #ffffff;
-        border-left: 5px solid #4CAF50;
-        color: #000000;
-        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-    }
-    .message-header {
-        font-weight: bold;
-        margin-bottom: 0.5rem;
-        color: #1976D2;
-    }
-    .assistant-message .message-header {
-        color: #2E7D32;
+# ==================== SESSION PERSISTENCE ====================
+def get_session_id():
+    """Reads the session id from the sid cookie, or creates a new one"""
+    sid = st.context.cookies.get("sid")
+    if not sid or not re.fullmatch(r"[0-9a-f]{32}", sid):
+        sid = uuid.uuid4().hex
+    # Older links carried the id in the URL; never keep it there
+    st.query_params.pop("sid", None)
+    return sid
+
+def set_session_cookie(sid):
+    """
+    Stores sid in a first-party cookie so a browser refresh finds the same session.
+    Streamlit cannot set cookies server-side, so a zero-height component sets it from the page.
+    """
+    components.html(f"""<script>
+        const secure = window.parent.location.protocol === "https:" ? "; Secure" : "";
+        window.parent.document.cookie =
+            "sid={sid}; path=/; max-age={SESSION_COOKIE_MAX_AGE}; SameSite=Strict" + secure;
+    </script>""", height=0)
+
+def session_path(sid):
+    return os.path.join(SESSIONS_DIR, f"{sid}.json")
+
+def load_session(sid):
+    """Returns the saved session for sid, or None if it is missing or malformed"""
+    try:
+        with open(session_path(sid), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not (
+        isinstance(data, dict)
+        and isinstance(data.get("messages"), list)
+        and isinstance(data.get("conversation_history"), list)
+        and isinstance(data.get("university_name"), str)
+        and all(isinstance(m, dict) and {"role", "content"} <= m.keys() for m in data["messages"])
+    ):
+        return None
+    return data
+
+def save_session(sid):
+    """Persists the last SESSION_MAX_TURNS turns of the current session"""
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    data = {
+        "messages": st.session_state.messages[-2 * SESSION_MAX_TURNS:],
+        "conversation_history": st.session_state.conversation_history[-SESSION_MAX_TURNS:],
+        "university_name": st.session_state.university_name
     }
-    </style>
-""", unsafe_allow_html=True)
+    with open(session_path(sid), "w", encoding="utf-8") as f:
+        json.dump(data, f)
 
 # ==================== INITIALIZE SESSION STATE ====================
+if "session_id" not in st.session_state:
+    st.session_state.session_id = get_session_id()
+    set_session_cookie(st.session_state.session_id)
+    saved_session = load_session(st.session_state.session_id)
+    if saved_session:
+        st.session_state.messages = saved_session["messages"]
+        st.session_state.conversation_history = saved_session["conversation_history"]
+        st.session_state.university_name = saved_session["university_name"]
+        st.session_state.example_clicked = bool(saved_session["messages"])
+
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
@@ -70,6 +109,35 @@ if "show_welcome" not in st.session_state:
 if "example_clicked" not in st.session_state:
     st.session_state.example_clicked = False
 
+if "last_submit_token" not in st.session_state:
+    st.session_state.last_submit_token = None
+    st.session_state.last_submit_time = 0.0
+
+def is_duplicate_submit(text):
+    """Returns True if the same text was just submitted (double-click / double-Enter)"""
+    token = hashlib.sha1(text.encode()).hexdigest()
+    now = time.monotonic()
+    duplicate = (
+        token == st.session_state.last_submit_token
+        and now - st.session_state.last_submit_time < DUPLICATE_SUBMIT_WINDOW
+    )
+    st.session_state.last_submit_token = token
+    st.session_state.last_submit_time = now
+    return duplicate
+
+# ==================== RENDERING ====================
+def render_session_stats():
+    st.subheader("📊 Session Stats")
+    st.metric("Total Questions", len(st.session_state.messages) // 2)
+    st.metric("Current Context", st.session_state.university_name)
+
+def render_chat():
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"], avatar="👤" if message["role"] == "user" else "🤖"):
+            if message["role"] == "assistant":
+                st.caption(f"{message.get('university', 'Assistant')} Assistant")
+            st.markdown(message["content"])
+
 # ==================== SIDEBAR ====================
 with st.sidebar:
     st.title("🎓 University Assistant")
@@ -116,9 +184,7 @@ with st.sidebar:
     st.markdown("---")
     
     # Stats
-    st.subheader("📊 Session Stats")
-    st.metric("Total Questions", len(st.session_state.messages) // 2)
-    st.metric("Current Context", st.session_state.university_name)
+    render_session_stats()
     
     st.markdown("---")
     
@@ -127,6 +193,7 @@ with st.sidebar:
         st.session_state.messages = []
         st.session_state.conversation_history = []
         st.session_state.example_clicked = False  # Reset welcome message
+        save_session(st.session_state.session_id)
         st.rerun()
 
 # ==================== MAIN CHAT INTERFACE ====================
@@ -137,22 +204,7 @@ st.markdown("---")
 # Display chat messages
 chat_container = st.container()
 with chat_container:
-    for message in st.session_state.messages:
-        if message["role"] == "user":
-            st.markdown(f"""
-                <div class="chat-message user-message">
-                    <div class="message-header">👤 You</div>
-                    <div>{message["content"]}</div>
-                </div>
-            """, unsafe_allow_html=True)
-        else:
-            university = message.get("university", "Assistant")
-            st.markdown(f"""
-                <div class="chat-message assistant-message">
-                    <div class="message-header">🤖 {university} Assistant</div>
-                    <div>{message["content"]}</div>
-                </div>
-            """, unsafe_allow_html=True)
+    render_chat()
 
 # ==================== CHAT INPUT ====================
 # Use chat_input which automatically submits on Enter
@@ -161,7 +213,7 @@ user_input = st.chat_input(
 )
 
 # ==================== PROCESS USER INPUT ====================
-if user_input:
+if user_input and not is_duplicate_submit(user_input):
     # Mark that user has started chatting - hide welcome
     st.session_state.example_clicked = True
     
@@ -210,7 +262,7 @@ if not st.session_state.example_clicked and "pending_query" not in st.session_st
                 question, 
                 key=f"example_{idx}", 
                 use_container_width=True
-            ):
+            ) and not is_duplicate_submit(question):
                 # FIRST: Mark that example was clicked - this makes welcome disappear on next rerun
                 st.session_state.example_clicked = True
                 
@@ -256,6 +308,7 @@ if "pending_query" in st.session_state:
     
     # Mark processing as complete
     st.session_state.is_processing = False
+    save_session(st.session_state.session_id)
     
     # Rerun to display new messages
     st.rerun()
@@ -3,13 +3,18 @@ Backend LangGraph Workflow
 Contains only the graph construction and workflow compilation
 """
 
+import os
+import re
+import asyncio
+import threading
+import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from langgraph.graph import StateGraph, END
 from helper_functions import (
     State,
     load_all_vector_dbs,
     user_input_node,
-    query_rewriter_node,
-    supervisor_node,
+    rewrite_and_route_node,
     create_university_agent,
     general_agent,
     quality_checker_node,
@@ -18,13 +23,32 @@ from helper_functions import (
     route_quality_checker
 )
 
+# ==================== EVENT LOOP ====================
+# All I/O-bound nodes are async; one long-lived loop runs every graph invocation
+# so async LLM clients stay bound to the same loop, and concurrent sessions
+# share it while they wait on Gemini. uvloop is used when installed (not on Windows).
+try:
+    import uvloop
+    _LOOP = uvloop.new_event_loop()
+except ImportError:
+    _LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, daemon=True, name="workflow-loop").start()
+
+def run_async(coro):
+    """Run a coroutine on the shared workflow loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _LOOP).result()
+
 # ==================== LOAD VECTOR DATABASES ====================
-VECTOR_DBS = load_all_vector_dbs()
+@st.cache_resource(show_spinner=False)
+def get_vector_dbs():
+    """Load the FAISS databases once and share them across sessions"""
+    return load_all_vector_dbs()
 
 # ==================== CREATE UNIVERSITY AGENTS ====================
-nust_agent = create_university_agent("NUST", VECTOR_DBS)
-comsats_agent = create_university_agent("COMSATS", VECTOR_DBS)
-fast_agent = create_university_agent("FAST", VECTOR_DBS)
+@st.cache_resource(show_spinner=False)
+def get_agent(university_name: str):
+    """Create (once) the agent for a specific university"""
+    return create_university_agent(university_name, get_vector_dbs())
 
 # ==================== BUILD LANGGRAPH WORKFLOW ====================
 
@@ -33,26 +57,29 @@ def build_workflow():
     
     graph = StateGraph(State)
     
+    # Create the independent university agents concurrently
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        nust_agent, comsats_agent, fast_agent = ex.map(get_agent, ["NUST", "COMSATS", "FAST"])
+    
     # Add all nodes
     graph.add_node("user_input", user_input_node)
-    graph.add_node("supervisor", supervisor_node)
+    graph.add_node("rewrite_and_route", rewrite_and_route_node)
     graph.add_node("nust_agent", nust_agent)
     graph.add_node("comsats_agent", comsats_agent)
     graph.add_node("fast_agent", fast_agent)
     graph.add_node("general_agent", general_agent)
     graph.add_node("quality_checker", quality_checker_node)
-    graph.add_node("query_rewriter", query_rewriter_node)
     graph.add_node("printer", printer_node)
     
     # Set entry point
     graph.set_entry_point("user_input")
     
     # Define workflow edges
-    graph.add_edge("user_input", "supervisor")
+    graph.add_edge("user_input", "rewrite_and_route")
     
-    # Supervisor routes to appropriate agent
+    # Rewrite + route (one LLM call) picks the appropriate agent
     graph.add_conditional_edges(
-        "supervisor",
+        "rewrite_and_route",
         route_supervisor,
         {
             "nust_agent": "nust_agent",
@@ -68,19 +95,16 @@ def build_workflow():
     graph.add_edge("fast_agent", "quality_checker")
     graph.add_edge("general_agent", "quality_checker")
     
-    # Quality checker routes to printer or query rewriter
+    # Quality checker routes to printer or back to rewrite + route
     graph.add_conditional_edges(
         "quality_checker",
         route_quality_checker,
         {
             "GOOD": "printer",
-            "BAD": "query_rewriter"
+            "BAD": "rewrite_and_route"
         }
     )
     
-    # Query rewriter loops back to supervisor
-    graph.add_edge("query_rewriter", "supervisor")
-    
     # Printer ends the workflow
     graph.add_edge("printer", END)
     
@@ -88,8 +112,88 @@ def build_workflow():
     return graph.compile()
 
 # ==================== COMPILE WORKFLOW ====================
-workflow = build_workflow()
-print("✅ RAG workflow compiled successfully!")
+@st.cache_resource(show_spinner=False)
+def get_workflow():
+    """Compile the workflow once per process instead of on every rerun"""
+    compiled = build_workflow()
+    print("✅ RAG workflow compiled successfully!")
+    
+    # Optional warmup so the first real query doesn't pay model/BLAS/TLS first-call costs
+    if os.getenv("WARMUP") == "1":
+        try:
+            run_async(compiled.ainvoke({
+                "user_query": "hello",
+                "conversation_history": [],
+                "university_name": "COMSATS"
+            }))
+            print("✅ RAG workflow warmed up!")
+        except Exception as e:
+            print(f"Warmup failed: {e}")
+    
+    return compiled
+
+workflow = get_workflow()
+
+# ==================== QUERY CACHE ====================
+RECENT_HISTORY_TURNS = 6
+
+def truncate_history(conversation_history: list, k_recent: int = RECENT_HISTORY_TURNS) -> list:
+    """
+    Keeps only the newest k_recent turns so the history stays bounded however long
+    the chat gets. Older turns are dropped, not summarized: no graph node reads the
+    history yet, it is only passed through the state and the cache key.
+    """
+    return conversation_history[-k_recent:]
+
+def history_key(conversation_history: list) -> tuple:
+    """Cheap, bounded hashable view of the most recent conversation turns"""
+    return tuple(
+        (entry.get("university", ""), entry.get("question", ""), entry.get("answer", ""))
+        for entry in conversation_history[-RECENT_HISTORY_TURNS:]
+    )
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_invoke(query: str, university_name: str, history_key: tuple):
+    """Run the workflow once per (query, university, recent history) and memoize the result"""
+    recent_history = [
+        {"university": uni, "question": question, "answer": answer}
+        for uni, question, answer in history_key
+    ]
+    result = run_async(workflow.ainvoke({
+        "user_query": query,
+        "conversation_history": recent_history,
+        "university_name": university_name
+    }))
+    
+    return {
+        "answer": result.get("answer", "Sorry, I couldn't generate an answer."),
+        "university_name": result.get("university_name", university_name),
+        # Only the entries produced by this turn, the caller owns the full history
+        "new_entries": result.get("conversation_history", [])[len(recent_history):]
+    }
+
+# ==================== TRIVIAL QUERY FAST PATH ====================
+# Whole-message chit-chat only, so "hi, what is the NUST fee?" still goes to the graph
+TRIVIAL_QUERY_RE = re.compile(
+    r"^\s*(hi|hello|hey|thanks|thank you|bye|who are you)\s*[!.?]*\s*$", re.I
+)
+
+CANNED_REPLIES = {
+    "hi": "Hello! Ask me anything about NUST, COMSATS or FAST.",
+    "hello": "Hello! Ask me anything about NUST, COMSATS or FAST.",
+    "hey": "Hey! Ask me anything about NUST, COMSATS or FAST.",
+    "thanks": "You're welcome! Let me know if you have any other questions.",
+    "thank you": "You're welcome! Let me know if you have any other questions.",
+    "bye": "Goodbye! Good luck with your studies.",
+    "who are you": "I'm a university information assistant for NUST, COMSATS and FAST. "
+                   "I can help with admissions, programs, fees, facilities and more."
+}
+
+def _is_trivial(query: str) -> bool:
+    return TRIVIAL_QUERY_RE.match(query) is not None
+
+def _canned_reply(query: str) -> str:
+    return CANNED_REPLIES[TRIVIAL_QUERY_RE.match(query).group(1).lower()]
 
 # ==================== MAIN INTERFACE FUNCTION ====================
 
@@ -107,20 +211,26 @@ def process_query(query: str, conversation_history: list = None, university_name
     """
     if conversation_history is None:
         conversation_history = []
+    conversation_history = truncate_history(conversation_history)
     
-    input_state = {
-        "user_query": query,
-        "conversation_history": conversation_history,
-        "university_name": university_name
-    }
+    # Answer greetings/thanks locally without any LLM call
+    if _is_trivial(query):
+        answer = _canned_reply(query)
+        return {
+            "answer": answer,
+            "university_name": university_name,
+            "conversation_history": conversation_history + [
+                {"university": "GENERAL", "question": query, "answer": answer}
+            ]
+        }
     
     try:
-        result = workflow.invoke(input_state)
+        result = _cached_invoke(query, university_name, history_key(conversation_history))
         
         return {
-            "answer": result.get("answer", "Sorry, I couldn't generate an answer."),
-            "university_name": result.get("university_name", university_name),
-            "conversation_history": result.get("conversation_history", [])
+            "answer": result["answer"],
+            "university_name": result["university_name"],
+            "conversation_history": conversation_history + result["new_entries"]
         }
     except Exception as e:
         print(f"Error processing query: {e}")
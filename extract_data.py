@@ -1,9 +1,23 @@
 import os
+import json
+import hashlib
+import uuid
+import faiss
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
 from docx import Document as DocxDocument
+from docx.oxml.table import CT_Tbl
+from docx.oxml.text.paragraph import CT_P
+from docx.table import Table
+from docx.text.paragraph import Paragraph
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
+from onnx_embeddings import USE_ONNX_EMBEDDINGS, OnnxMiniLMEmbeddings
+from sqlite_docstore import DOCSTORE_FILE, write_sqlite_docstore
 # -------------------------
 # CONFIG
 # -------------------------
@@ -28,6 +42,61 @@ from langchain_core.documents import Document
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 
+# Embedding settings
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = 256
+
+# HNSW graph parameters for the saved FAISS indices
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+
+# Per-DB record of source docx hashes, used to skip unchanged files
+MANIFEST_FILE = "manifest.json"
+
+# Universities are ingested in parallel, one process each
+MAX_INGEST_WORKERS = 3
+
+# Set SAVE_CHUNKS=1 to also dump every chunk to CHUNKS_BASE_DIR/<university>_chunks/chunks.jsonl
+SAVE_CHUNKS = os.getenv("SAVE_CHUNKS", "0") == "1"
+
+# Shared splitter, built once instead of per section
+SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+)
+
+def get_embeddings(use_gpu=True):
+    """
+    Builds the embedding model used for ingestion.
+    - Runs on GPU in FP16 with large batches when CUDA is available and use_gpu is set.
+    - Falls back to CPU FP32 otherwise.
+    - Uses the int8 ONNX model instead when EMBEDDINGS_BACKEND=onnx.
+    """
+    if USE_ONNX_EMBEDDINGS:
+        return OnnxMiniLMEmbeddings(EMBEDDING_MODEL, batch_size=EMBED_BATCH_SIZE)
+
+    if use_gpu and torch.cuda.is_available():
+        model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+    else:
+        model_kwargs = {"device": "cpu"}
+
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs=model_kwargs,
+        encode_kwargs={
+            "batch_size": EMBED_BATCH_SIZE,
+            "normalize_embeddings": True,
+            "convert_to_numpy": True,
+        },
+    )
+
+def iter_block_items(parent):
+    """Yields the Paragraph and Table objects of a document body in document order"""
+    for child in parent.element.body.iterchildren():
+        if isinstance(child, CT_P):
+            yield Paragraph(child, parent)
+        elif isinstance(child, CT_Tbl):
+            yield Table(child, parent)
+
 def extract_chunks_from_docx(file_path, university_name):
     """
     Extracts Word document content into chunks:
@@ -42,23 +111,18 @@ def extract_chunks_from_docx(file_path, university_name):
     current_content = []
 
     # Iterate through all elements in the document (paragraphs + tables)
-    for block in doc.element.body:
-        if block.tag.endswith("p"):  # Paragraph
-            para = block
-            text = para.text.strip() if hasattr(para, "text") else ""
+    for item in iter_block_items(doc):
+        if isinstance(item, Paragraph):
+            text = item.text.strip()
             if not text:
                 continue
 
             # Detect heading
-            para_obj = next((p for p in doc.paragraphs if p._p == para), None)
-            if para_obj and para_obj.style.name.startswith("Heading"):
+            if item.style.name.startswith("Heading"):
                 # Save previous heading + content
                 if current_heading:
                     combined_text = current_heading + "\n" + "\n".join(current_content)
-                    text_splitter = RecursiveCharacterTextSplitter(
-                        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
-                    )
-                    for split_text in text_splitter.split_text(combined_text):
+                    for split_text in SPLITTER.split_text(combined_text):
                         chunks.append(
                             Document(
                                 page_content=split_text,
@@ -78,24 +142,18 @@ def extract_chunks_from_docx(file_path, university_name):
             else:
                 current_content.append(text)
 
-        elif block.tag.endswith("tbl"):  # Table
-            # Find corresponding docx table object
-            table_obj = next((t for t in doc.tables if t._tbl == block), None)
-            if table_obj:
-                table_text = []
-                for row in table_obj.rows:
-                    row_data = [cell.text.strip() for cell in row.cells]
-                    table_text.append(" | ".join(row_data))
-                # Convert table to readable markdown-like text
-                current_content.append("\n".join(table_text))
+        elif isinstance(item, Table):
+            # Convert table to readable markdown-like text
+            table_text = "\n".join(
+                " | ".join(cell.text.strip() for cell in row.cells)
+                for row in item.rows
+            )
+            current_content.append(table_text)
 
     # Handle last section
     if current_heading and current_content:
         combined_text = current_heading + "\n" + "\n".join(current_content)
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
-        )
-        for split_text in text_splitter.split_text(combined_text):
+        for split_text in SPLITTER.split_text(combined_text):
             chunks.append(
                 Document(
                     page_content=split_text,
@@ -111,67 +169,162 @@ def extract_chunks_from_docx(file_path, university_name):
     return chunks
 
 
-def create_chunks_and_vector_db(university_name, docs_folder):
+def embed_documents_batched(docs, embeddings):
+    """Embeds documents in EMBED_BATCH_SIZE batches into one preallocated float32 array"""
+    vectors = None
+    for i in range(0, len(docs), EMBED_BATCH_SIZE):
+        batch = embeddings.embed_documents([d.page_content for d in docs[i:i + EMBED_BATCH_SIZE]])
+        if vectors is None:
+            vectors = np.empty((len(docs), len(batch[0])), dtype=np.float32)
+        vectors[i:i + len(batch)] = batch
+    return vectors
+
+def add_vectors(vector_db, docs, vectors):
+    """
+    Adds docs with their precomputed (n, d) float32 vectors straight to the FAISS index
+    and docstore; add_embeddings/from_embeddings would copy the array into tuples again
+    """
+    ids = [str(uuid.uuid4()) for _ in docs]
+    start = vector_db.index.ntotal
+    vector_db.index.add(vectors)
+    vector_db.docstore.add({
+        doc_id: Document(id=doc_id, page_content=d.page_content, metadata=d.metadata)
+        for doc_id, d in zip(ids, docs)
+    })
+    vector_db.index_to_docstore_id.update(enumerate(ids, start))
+
+def rebuild_index(vector_db, index):
+    """Moves all vectors of a FAISS vector store into a fresh (empty) index"""
+    vectors = vector_db.index.reconstruct_n(0, vector_db.index.ntotal)
+    index.add(vectors)
+    vector_db.index = index
+
+def to_hnsw(vector_db):
+    """Replaces the flat index with an HNSW graph for sub-linear search"""
+    index = faiss.IndexHNSWFlat(vector_db.index.d, HNSW_M)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    rebuild_index(vector_db, index)
+
+def to_flat(vector_db):
+    """Replaces an HNSW index with a flat one (HNSW does not support deletes)"""
+    rebuild_index(vector_db, faiss.IndexFlatL2(vector_db.index.d))
+
+def file_hash(file_path):
+    """Returns the sha256 hex digest of a file's contents"""
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_manifest(vector_db_path):
+    """Loads the {filename: hash} manifest of the last build, or {} if there is none"""
+    manifest_path = os.path.join(vector_db_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(vector_db_path, manifest):
+    """Writes the {filename: hash} manifest next to the FAISS index"""
+    with open(os.path.join(vector_db_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+def create_chunks_and_vector_db(university_name, docs_folder, save_chunks=False, use_gpu=True):
     """
-    Extracts chunks from all docs in a folder, splits large chunks, and creates a FAISS vector DB.
-    Stores chunks and DB in separate folders per university.
+    Extracts chunks from all docs in a folder and creates a FAISS vector DB.
+    - Only docx files whose hash changed since the last build are re-parsed and re-embedded.
+    - Stores the DB (and, if save_chunks is set, a chunks.jsonl dump) in separate folders per university.
     """
-    # Step 1: Extract chunks from all documents
-    all_chunks = []
+    vector_db_path = os.path.join(VECTOR_DB_BASE_DIR, f"{university_name}_faiss")
+
+    # Step 1: Diff current docx hashes against the last build's manifest
+    manifest = {}
     for file in os.listdir(docs_folder):
         if file.endswith(".docx") and not file.startswith("~$"):
-            file_path = os.path.join(docs_folder, file)
-            print(f"[{university_name}] Processing {file_path}")
-            chunks = extract_chunks_from_docx(file_path, university_name)
-            all_chunks.extend(chunks)
+            manifest[file] = file_hash(os.path.join(docs_folder, file))
 
+    old_manifest = load_manifest(vector_db_path)
+    has_index = bool(old_manifest) and os.path.exists(os.path.join(vector_db_path, "index.faiss"))
+    changed = [f for f in manifest if old_manifest.get(f) != manifest[f]]
+    removed = [f for f in old_manifest if f not in manifest]
 
-    # Step 2: Further split large chunks
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP
-    )
+    if has_index and not changed and not removed:
+        print(f"[{university_name}] Vector DB is up to date, skipping")
+        return
+
+    embeddings = get_embeddings(use_gpu)
+    vector_db = None
+    files_to_process = list(manifest)
+
+    if has_index:
+        vector_db = FAISS.load_local(vector_db_path, embeddings, allow_dangerous_deserialization=True)
+        to_flat(vector_db)
+        stale = set(changed) | set(removed)
+        stale_ids = [
+            doc_id for doc_id in vector_db.index_to_docstore_id.values()
+            if vector_db.docstore.search(doc_id).metadata.get("source_file") in stale
+        ]
+        if stale_ids:
+            vector_db.delete(ids=stale_ids)
+        files_to_process = changed
 
+    # Step 2: Extract chunks from new/changed documents (already split to CHUNK_SIZE)
     final_docs = []
-    for doc in all_chunks:
-        splits = text_splitter.split_text(doc.page_content)
-        for s in splits:
-            final_docs.append(Document(page_content=s, metadata=doc.metadata))
+    for file in files_to_process:
+        file_path = os.path.join(docs_folder, file)
+        print(f"[{university_name}] Processing {file_path}")
+        final_docs.extend(extract_chunks_from_docx(file_path, university_name))
 
     print(f"[{university_name}] Total chunks for embeddings: {len(final_docs)}")
 
-    # Step 3: Save chunks to folder (optional)
-    chunks_folder = os.path.join(CHUNKS_BASE_DIR, f"{university_name}_chunks")
-    os.makedirs(chunks_folder, exist_ok=True)
-    for i, doc in enumerate(final_docs):
-        chunk_file = os.path.join(chunks_folder, f"chunk_{i}.txt")
-        with open(chunk_file, "w", encoding="utf-8") as f:
-            f.write(doc.page_content)
-
-    # Step 4: Create vector DB using huggingface embeddings
-    embeddings = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L6-v2"
-)
-    vector_db = FAISS.from_documents(final_docs, embeddings)
+    # Step 3: Create or update vector DB using huggingface embeddings
+    if final_docs:
+        vectors = embed_documents_batched(final_docs, embeddings)
+        if vector_db is None:
+            vector_db = FAISS(embeddings, faiss.IndexFlatL2(vectors.shape[1]), InMemoryDocstore(), {})
+        add_vectors(vector_db, final_docs, vectors)
+    elif vector_db is None:
+        raise ValueError(f"[{university_name}] No chunks extracted from {docs_folder}")
 
-    # Step 5: Save vector DB
-    vector_db_path = os.path.join(VECTOR_DB_BASE_DIR, f"{university_name}_faiss")
+    to_hnsw(vector_db)
+
+    # Step 4: Save chunks to a single JSONL file (optional)
+    if save_chunks:
+        chunks_folder = os.path.join(CHUNKS_BASE_DIR, f"{university_name}_chunks")
+        os.makedirs(chunks_folder, exist_ok=True)
+        all_docs = [vector_db.docstore.search(doc_id) for doc_id in vector_db.index_to_docstore_id.values()]
+        with open(os.path.join(chunks_folder, "chunks.jsonl"), "w", encoding="utf-8") as f:
+            for i, doc in enumerate(all_docs):
+                f.write(json.dumps({"id": i, "text": doc.page_content, "meta": doc.metadata}) + "\n")
+
+    # Step 5: Save vector DB and manifest
     os.makedirs(vector_db_path, exist_ok=True)
     vector_db.save_local(vector_db_path)
+    # Read-only copy of the docstore that the app loads lazily instead of index.pkl
+    write_sqlite_docstore(os.path.join(vector_db_path, DOCSTORE_FILE), vector_db)
+    save_manifest(vector_db_path, manifest)
 
     print(f"[{university_name}] Vector DB saved at {vector_db_path}")
 
+def _process_university(job):
+    """Top-level (picklable) worker for the ingestion process pool"""
+    university_name, docs_folder, save_chunks, use_gpu = job
+    create_chunks_and_vector_db(university_name, docs_folder, save_chunks=save_chunks, use_gpu=use_gpu)
+
 # -------------------------
 # MAIN
 # -------------------------
 if __name__ == "__main__":
-    os.makedirs(CHUNKS_BASE_DIR, exist_ok=True)
     os.makedirs(VECTOR_DB_BASE_DIR, exist_ok=True)
 
-    # Loop through each university folder
+    # Collect each university folder
+    uni_paths = []
     for university_folder in os.listdir(BASE_DATA_DIR):
         uni_path = os.path.join(BASE_DATA_DIR, university_folder)
         if os.path.isdir(uni_path):
-            create_chunks_and_vector_db(university_folder, uni_path)
+            uni_paths.append((university_folder, uni_path))
+
+    # Process universities in parallel; only the first worker uses the GPU
+    jobs = [(name, path, SAVE_CHUNKS, i == 0) for i, (name, path) in enumerate(uni_paths)]
+    with ProcessPoolExecutor(max_workers=max(1, min(MAX_INGEST_WORKERS, len(jobs)))) as ex:
+        list(ex.map(_process_university, jobs))
 
     print("All universities processed successfully!")
@@ -6,17 +6,36 @@ Contains all utility functions, RAG chains, and LangGraph nodes
 
 from typing_extensions import TypedDict
 from typing import Annotated, List, Dict
-from operator import add
+from operator import add, itemgetter
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableParallel
+from langchain_core.documents import Document
 from langchain_community.vectorstores import FAISS
+from sentence_transformers import CrossEncoder
+from onnx_embeddings import USE_ONNX_EMBEDDINGS, OnnxMiniLMEmbeddings
+from sqlite_docstore import DOCSTORE_FILE, SqliteDocstore
 import os
+import re
+import string
+import asyncio
+import functools
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Share FAISS's OpenMP pool between concurrent requests instead of oversubscribing cores
+faiss.omp_set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+
 # ==================== STATE DEFINITION ====================
 class State(TypedDict):
     user_query: str
@@ -25,49 +44,236 @@ class State(TypedDict):
     context: str
     answer: str
     quality_passed: bool
+    last_doc_ids: List[str]
+    cache_token: str
     conversation_history: Annotated[List[Dict[str, str]], add]
 
 # ==================== CONFIGURATION ====================
 VECTOR_DB_BASE_DIR = "./VectorDBs"
+HNSW_EF_SEARCH = 64
+RETRIEVAL_K = 25
+RERANK_TOP_K = 5
+FORMATTED_CONTEXT_CACHE_SIZE = 256
+# Cross-encoder logit above which an answer passes; scores within the margin go to the LLM
+QUALITY_SCORE_THRESHOLD = 0.0
+QUALITY_SCORE_MARGIN = 1.0
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 300
+SEMANTIC_CACHE_MAX_ENTRIES = 1024
+
+# ==================== SHARED MODELS ====================
+# One embedding model for all universities (loading MiniLM is the expensive part)
+if USE_ONNX_EMBEDDINGS:
+    EMBEDDINGS = OnnxMiniLMEmbeddings("sentence-transformers/all-MiniLM-L6-v2")
+else:
+    EMBEDDINGS = HuggingFaceEmbeddings(
+        model_name="sentence-transformers/all-MiniLM-L6-v2",
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"normalize_embeddings": True}
+    )
+
+# Cross-encoder that reranks the RETRIEVAL_K candidates down to RERANK_TOP_K
+RERANKER = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
+
+def rerank(query, docs, top_k=RERANK_TOP_K):
+    """Keep the top_k docs by cross-encoder relevance (one batched forward pass)"""
+    if len(docs) <= 1:
+        return docs
+    scores = RERANKER.predict([(query, d.page_content) for d in docs])
+    ranked = sorted(zip(scores, range(len(docs))), reverse=True)[:top_k]
+    return [docs[i] for _, i in ranked]
+
+# LLM settings by role; each client is built on first use and then reused
+LLM_CONFIGS = {
+    "flash25": {"model": "gemini-2.5-flash", "temperature": 0.2, "max_tokens": None, "timeout": None, "max_retries": 2},
+    "flash20": {"model": "gemini-2.0-flash", "temperature": 0}
+}
+
+@functools.lru_cache(maxsize=None)
+def get_llm(name):
+    """
+    Return the shared ChatGoogleGenerativeAI client for a role in LLM_CONFIGS.
+    The transport is left at its default (grpc for sync calls, grpc_asyncio for the
+    ainvoke path every node uses); forcing "grpc" breaks the async client.
+    """
+    return ChatGoogleGenerativeAI(**LLM_CONFIGS[name])
 
 # ==================== VECTOR DB LOADING ====================
-def load_vector_db(university_name):
+def load_vector_db(university_name, embeddings=EMBEDDINGS):
     """Load FAISS vector database for a specific university"""
     vector_db_path = os.path.join(VECTOR_DB_BASE_DIR, f"{university_name}_faiss")
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    db = FAISS.load_local(vector_db_path, embeddings, allow_dangerous_deserialization=True)
+    # Memory-map the index so the OS page cache is shared across worker processes.
+    # IO_FLAG_MMAP_IFC (faiss >= 1.10) maps the codes of flat/HNSW storage read-only;
+    # IO_FLAG_MMAP and IO_FLAG_READ_ONLY only affect IVF lists.
+    index = faiss.read_index(os.path.join(vector_db_path, "index.faiss"), faiss.IO_FLAG_MMAP_IFC)
+    # Chunks are read from the sqlite docstore on demand; DBs built before it existed
+    # fall back to unpickling the whole docstore
+    docstore_path = os.path.join(vector_db_path, DOCSTORE_FILE)
+    if os.path.exists(docstore_path):
+        docstore = SqliteDocstore(docstore_path)
+        index_to_docstore_id = docstore.index_to_docstore_id()
+    else:
+        with open(os.path.join(vector_db_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    db = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    if hasattr(db.index, "hnsw"):
+        db.index.hnsw.efSearch = HNSW_EF_SEARCH
+    # Touch the index once so the first real query doesn't pay the page-in cost
+    db.similarity_search("warmup", k=1)
     return db
 
 def load_all_vector_dbs():
-    """Load all vector databases at startup"""
+    """Load all vector databases at startup (concurrently, they are independent)"""
     print("🔄 Loading vector databases...")
-    dbs = {
-        "NUST": load_vector_db("nust"),
-        "COMSATS": load_vector_db("comsats"),
-        "FAST": load_vector_db("fast")
-    }
+    names = ["NUST", "COMSATS", "FAST"]
+    with ThreadPoolExecutor(max_workers=len(names)) as ex:
+        dbs = dict(zip(names, ex.map(load_vector_db, [name.lower() for name in names])))
     print("✅ All vector databases loaded!")
     return dbs
 
-# ==================== RAG CHAIN CREATION ====================
-def create_rag_chain(db, university_name):
-    """Create a RAG chain for a specific university"""
-    retriever = db.as_retriever(
-        search_type="similarity", 
-        search_kwargs={"k": 5}
-    )
+# ==================== SEMANTIC CACHE ====================
+class SemanticCache:
+    """
+    Approximate answer cache: a query whose normalized embedding has cosine
+    similarity >= threshold with a cached query reuses that query's answer.
+    Vectors are stored as 8-bit codes, well within tolerance for the threshold check.
+    Entries expire after ttl seconds and the least recently used is evicted when full.
+    """
     
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0.2,
-        max_tokens=None,
-        timeout=None,
-        max_retries=2
-    )
+    def __init__(self, dim, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL,
+                 max_entries=SEMANTIC_CACHE_MAX_ENTRIES):
+        # 8-bit scalar-quantized inner-product index; normalized vectors lie in [-1, 1]
+        self.index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        self.index.train(np.stack([-np.ones(dim, dtype=np.float32), np.ones(dim, dtype=np.float32)]))
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = []  # entries[i] belongs to index position i: {"answer", "context", "ts", "last_used"}
+        # Answers awaiting the quality check, by cache token; only passing ones are added
+        self.pending = {}
+        self.lock = threading.RLock()
     
-    uni_display_name = university_name.upper()
+    def _remove(self, positions):
+        # IndexFlatCodes.remove_ids compacts the codes in order, so entries stay aligned
+        self.index.remove_ids(np.asarray(positions, dtype=np.int64))
+        removed = set(positions)
+        self.entries = [e for i, e in enumerate(self.entries) if i not in removed]
     
-    prompt = ChatPromptTemplate.from_messages([
+    def _purge_expired(self, now):
+        expired = [i for i, e in enumerate(self.entries) if now - e["ts"] >= self.ttl]
+        if expired:
+            self._remove(expired)
+    
+    def lookup(self, emb):
+        """Returns the cached entry ({"answer", "context", "doc_ids", ...}) for a similar query, or None"""
+        with self.lock:
+            now = time.time()
+            self._purge_expired(now)
+            if self.index.ntotal == 0:
+                return None
+            D, I = self.index.search(emb[None, :], 1)
+            if D[0, 0] < self.threshold:
+                return None
+            entry = self.entries[I[0, 0]]
+            entry["last_used"] = now
+            return entry
+    
+    def add(self, emb, answer, context, doc_ids=()):
+        with self.lock:
+            now = time.time()
+            if len(self.entries) >= self.max_entries:
+                self._remove([min(range(len(self.entries)), key=lambda i: self.entries[i]["last_used"])])
+            self.entries.append({
+                "answer": answer, "context": context, "doc_ids": list(doc_ids), "ts": now, "last_used": now
+            })
+            self.index.add(emb[None, :])
+
+    def stage(self, token, emb, answer, context, doc_ids=()):
+        """Hold a fresh answer under a per-attempt token until quality_checker_node has judged it"""
+        with self.lock:
+            if len(self.pending) >= self.max_entries:
+                self.pending.clear()
+            self.pending[token] = (emb, answer, context, doc_ids)
+    
+    def resolve(self, token, passed):
+        """Cache the answer staged under token if it passed the quality check, else discard it"""
+        with self.lock:
+            staged = self.pending.pop(token, None)
+        if staged is not None and passed:
+            self.add(*staged)
+
+# One cache per university so NUST/COMSATS/FAST answers never collide
+SEMANTIC_CACHES = {}
+_SEMANTIC_CACHES_LOCK = threading.Lock()
+
+def get_semantic_cache(university_name, dim):
+    with _SEMANTIC_CACHES_LOCK:
+        if university_name not in SEMANTIC_CACHES:
+            SEMANTIC_CACHES[university_name] = SemanticCache(dim)
+        return SEMANTIC_CACHES[university_name]
+
+def normalize_vector(vec):
+    """L2-normalize an embedding as a float32 vector"""
+    emb = np.asarray(vec, dtype=np.float32)
+    return emb / max(np.linalg.norm(emb), 1e-12)
+
+# ==================== EMBEDDING MICRO-BATCHING ====================
+class MicroBatcher:
+    """
+    Coalesces concurrent embed requests into one embed_documents call.
+    Callers await embed(text); a background task collects up to max_batch
+    pending texts (waiting at most max_wait seconds) and embeds them together.
+    """
+    
+    def __init__(self, embeddings, max_batch=32, max_wait=0.005):
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._task = None
+    
+    async def embed(self, text):
+        """Returns the L2-normalized float32 embedding of text"""
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                # Embedding is CPU-bound, keep it off the event loop
+                vectors = await asyncio.to_thread(self.embeddings.embed_documents, [text for text, _ in batch])
+                for (_, future), vec in zip(batch, vectors):
+                    if not future.done():
+                        future.set_result(normalize_vector(vec))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+EMBED_BATCHER = MicroBatcher(EMBEDDINGS)
+
+# ==================== PROMPT TEMPLATES ====================
+# Built once at import; nodes only substitute the per-request values
+def build_rag_prompt(uni_display_name):
+    """Build the answer prompt for one university"""
+    return ChatPromptTemplate.from_messages([
         ("system", f"""You are a helpful university information assistant for {uni_display_name}. 
         Your job is to answer student questions using the context provided from university documents.
 
@@ -84,93 +290,245 @@ def create_rag_chain(db, university_name):
 
         Answer:""")
     ])
+
+RAG_PROMPTS = {name: build_rag_prompt(name) for name in ["NUST", "COMSATS", "FAST"]}
+
+REWRITE_AND_ROUTE_TMPL = string.Template("""You are a query optimization and routing expert for university documents.
+
+    Context: The user was last asking about ${uni} university.
+
+    Task 1 - rewrite the user's question to make it more effective for searching university documents:
+    1. Make vague questions more specific and searchable
+    2. If the query is generic (like "tell me about", "info about", "what is"), expand it to ask about key aspects: history, campuses, programs, facilities, rankings, etc.
+    3. If the query mentions "this university", "here", or uses pronouns, replace them with the actual university name
+    4. Keep technical terms and specific questions as they are
+
+    Task 2 - decide which university the user is talking about. Possible universities: NUST, COMSATS, FAST.
+    1. If the query clearly mentions NUST, COMSATS, or FAST, answer with that university name
+    2. If no university is mentioned and user intends to continue about ${current_uni}, answer with ${current_uni}
+    3. If user mentions multiple universities, answer with GENERAL
+    4. If user mentions another university (not NUST/COMSATS/FAST), answer with that university name
+    5. Otherwise answer with GENERAL
+
+    Examples:
+    - "what is the fee structure of this university?" → ${current_uni}
+    - "which university has the best CS program?" → GENERAL
+    - "tell me about bahria university" → BAHRIA
+
+    Original question: ${query}
+
+    Respond with JSON: {"rewritten": "...", "university": "NUST|COMSATS|FAST|GENERAL|<other>"}""")
+
+GENERAL_TMPL = string.Template("""You are a knowledgeable assistant for university students. Answer the user's question directly, clearly and concisely.
+    If user mentions a specific university, provide relevant information about that university.
+    If user does not mention any university and intends to continue about ${uni}, provide information about ${uni} university.
+
+    Question: ${query}
+
+    Answer:""")
+
+QUALITY_TMPL = string.Template("""You are a quality evaluator. Rate the following answer based on:
+1. Relevance to the question
+2. Completeness
+3. Clarity
+
+Note: if the answer contains information related to query, even if minimal, it should be considered relevant and reply with YES.
+
+Question: ${query}
+Answer: ${answer}
+
+Respond with ONLY one word: YES or NO.""")
+
+# ==================== RAG CHAIN CREATION ====================
+def create_rag_chain(db, university_name):
+    """Create a RAG chain for a specific university"""
+    retriever = db.as_retriever(
+        search_type="similarity", 
+        search_kwargs={"k": RETRIEVAL_K}
+    )
+    
+    llm = get_llm("flash25")
+    
+    uni_display_name = university_name.upper()
+    
+    prompt = RAG_PROMPTS.get(uni_display_name) or build_rag_prompt(uni_display_name)
     
     parser = StrOutputParser()
     
+    # Only needed for indices built before Documents carried their docstore id
+    legacy_ids = {}
+    
+    def doc_id(d):
+        """Docstore id of a retrieved Document (set on d.id by FAISS when it was added)"""
+        if d.id:
+            return d.id
+        if not legacy_ids:
+            legacy_ids.update({id(db.docstore.search(i)): i for i in db.index_to_docstore_id.values()})
+        return legacy_ids.get(id(d))
+    
+    # Docstore ids identify a retrieval result
+    formatted_contexts = {}
+    
     def format_docs(docs):
         if not docs:
             return "No relevant documents found."
-        return "\n\n".join([f"[Document {i+1}]\n{d.page_content}" for i, d in enumerate(docs)])
+        key = tuple(doc_id(d) for d in docs)
+        context = formatted_contexts.get(key)
+        if context is None:
+            context = "\n\n".join(f"[Document {i}]\n{d.page_content}" for i, d in enumerate(docs, 1))
+            if len(formatted_contexts) >= FORMATTED_CONTEXT_CACHE_SIZE:
+                formatted_contexts.clear()
+            formatted_contexts[key] = context
+        return context
+    
+    def previous_docs(inputs):
+        """Documents retrieved by the previous attempt (retries only)"""
+        docs = (db.docstore.search(i) for i in inputs.get("previous_doc_ids") or [])
+        return [d for d in docs if isinstance(d, Document)]
     
-    def run_chain(query):
-        docs = retriever.invoke(query)
-        context = format_docs(docs)
-        messages = prompt.format_messages(context=context, question=query)
-        answer = llm.invoke(messages)
-        return parser.invoke(answer)
+    def merge_docs(new_docs, old_docs):
+        seen = {doc_id(d) for d in new_docs}
+        return new_docs + [d for d in old_docs if doc_id(d) not in seen]
+    
+    def retrieve_docs(inputs):
+        query = inputs["question"]
+        return rerank(query, merge_docs(retriever.invoke(query), previous_docs(inputs)))
+    
+    async def aretrieve_docs(inputs):
+        query = inputs["question"]
+        if "embedding" in inputs:
+            # Reuse the batched query embedding instead of embedding the query again
+            docs = await db.asimilarity_search_by_vector(inputs["embedding"].tolist(), k=RETRIEVAL_K)
+        else:
+            docs = await retriever.ainvoke(query)
+        return await asyncio.to_thread(rerank, query, merge_docs(docs, previous_docs(inputs)))
+    
+    # LCEL pipeline: {"question"[, "embedding", "previous_doc_ids"]} ->
+    # {"docs", "context", "question", "answer"}; supports invoke/ainvoke/astream
+    chain = RunnableParallel(
+        docs=RunnableLambda(retrieve_docs, afunc=aretrieve_docs),
+        question=itemgetter("question")
+    ).assign(
+        context=lambda x: format_docs(x["docs"])
+    ).assign(answer=prompt | llm | parser)
+    
+    semantic_cache = get_semantic_cache(uni_display_name, db.index.d)
+    
+    async def run_chain(query, cache_token, previous_doc_ids=None, retry=False):
+        """
+        Returns (answer, doc_ids); previous_doc_ids are merged into the candidates on retries.
+        Fresh answers are only staged in the semantic cache under cache_token;
+        quality_checker_node decides whether they are kept. Retries never read the cache,
+        or they could get back the answer that just failed.
+        """
+        emb = await EMBED_BATCHER.embed(query)
+        if not retry:
+            cached = semantic_cache.lookup(emb)
+            if cached is not None:
+                return cached["answer"], cached["doc_ids"]
+        
+        result = await chain.ainvoke({"question": query, "embedding": emb, "previous_doc_ids": previous_doc_ids})
+        doc_ids = [i for i in map(doc_id, result["docs"]) if i is not None]
+        semantic_cache.stage(cache_token, emb, result["answer"], result["context"], doc_ids)
+        return result["answer"], doc_ids
     
+    run_chain.chain = chain
     return run_chain
 
 # ==================== LANGGRAPH NODES ====================
 
+def effective_query(state: State):
+    """The query downstream nodes should use (rewrite_and_route_node always sets rewritten_query)"""
+    return state.get("rewritten_query") or state["user_query"]
+
 def user_input_node(state: State):
     """Entry point for user queries"""
     return {"user_query": state["user_query"]}
 
-def query_rewriter_node(state: State):
-    """Rewrites vague queries to be more specific and searchable"""
-    llm_rewriter = ChatGoogleGenerativeAI(
-        model="gemini-2.0-flash",
-        temperature=0
-    )
-    
-    uni_display_name = state['university_name'].upper()
+# Keyword routing: resolves explicit mentions without an LLM call
+# A bare "fast" is an ordinary word ("fast track", "how fast"), so FAST only counts in
+# capitals or in an unambiguous form; everything else is left to the LLM
+UNI_RE = re.compile(r"\b((?i:nust|comsats|nu[- ]?fast|nuces|fast[- ]nu|fast university)|FAST)\b")
+# "iba" and "ned" are also ordinary tokens (names, transliterated text), so they only
+# count next to a fuller name; bare mentions are left to the LLM
+OTHER_UNI_RE = re.compile(
+    r"\b(bahria|lums|giki|uet|pieas|air university|iiui|qau|quaid[- ]i[- ]azam|riphah|szabist"
+    r"|iba(?=[\s,-]+(?:karachi|sukkur)\b)|institute of business administration"
+    r"|ned(?=[\s-]+(?:university|uet|engineering)\b))\b",
+    re.I
+)
+OTHER_UNI_ALIASES = {"institute of business administration": "IBA"}
+UNI_ALIASES = {"nust": "NUST", "comsats": "COMSATS", "fast": "FAST", "nuces": "FAST"}
+
+def route_by_keywords(query):
+    """
+    Route a query from explicit university mentions.
+    Returns a university name, GENERAL, another university's name, or None
+    when nothing is mentioned and the LLM must decide (e.g. follow-up questions).
+    """
+    hits = {UNI_ALIASES.get(m.group(1).lower(), "FAST") for m in UNI_RE.finditer(query)}
+    other = OTHER_UNI_RE.search(query)
     
-    try:
-        prompt = f"""You are a query optimization expert. Rewrite the user's question to make it more effective for searching university documents.
-
-        Context: The user is asking about {uni_display_name} university.
-
-        Rules:
-        1. Make vague questions more specific and searchable
-        2. If the query is generic (like "tell me about", "info about", "what is"), expand it to ask about key aspects: history, campuses, programs, facilities, rankings, etc.
-        3. If the query mentions "this university", "here", or uses pronouns, replace them with the actual university name
-        4. Keep technical terms and specific questions as they are
-        5. Output ONLY the rewritten question, nothing else
+    if other:
+        return "GENERAL" if hits else OTHER_UNI_ALIASES.get(other.group(1).lower(), other.group(1).upper())
+    if len(hits) > 1:
+        return "GENERAL"
+    if len(hits) == 1:
+        return hits.pop()
+    return None
+
+# Phrases that mark a query as vague enough to be worth rewriting
+VAGUE_QUERY_RE = re.compile(
+    r"\b(tell me about|info about|information about|what is|this university|here|over there)\b", re.I
+)
+MIN_SPECIFIC_QUERY_WORDS = 6
+
+def needs_rewrite(query):
+    """Short, vague, or university-less queries benefit from rewriting; specific ones don't"""
+    return (
+        len(query.split()) < MIN_SPECIFIC_QUERY_WORDS
+        or VAGUE_QUERY_RE.search(query) is not None
+        or UNI_RE.search(query) is None
+    )
 
-        Original question: {state['user_query']}
+class RewriteAndRoute(TypedDict):
+    rewritten: str
+    university: str
 
-        Rewritten question:"""
-        
-        response = llm_rewriter.invoke(prompt)
-        rewritten_query = response.content.strip() if hasattr(response, 'content') else str(response).strip()
-        rewritten_query = rewritten_query.replace('**', '').replace('*', '').strip()
-        
-        if not rewritten_query or len(rewritten_query) < 5:
-            return {"rewritten_query": state['user_query']}
-        
-        return {"rewritten_query": rewritten_query}
-        
-    except Exception as e:
-        return {"rewritten_query": state['user_query']}
+@functools.lru_cache(maxsize=None)
+def get_rewrite_router():
+    """Shared structured-output LLM returning a RewriteAndRoute dict"""
+    return get_llm("flash20").with_structured_output(RewriteAndRoute)
 
-def supervisor_node(state: State):
-    """Routes queries to appropriate university agent based on context"""
-    llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
+async def rewrite_and_route_node(state: State):
+    """Rewrites the query and routes it to a university agent in a single LLM call"""
+    current_uni = state['university_name']
+    uni_display_name = current_uni.upper()
     
-    query_for_prompt = state.get("rewritten_query") or state["user_query"]
+    keyword_uni = route_by_keywords(state['user_query'])
     
-    prompt = f"""You are a routing agent. Decide which university the user is talking about.
-    Possible universities: NUST, COMSATS, FAST.
-
-    Your task:
-    1. If the query clearly mentions NUST, COMSATS, or FAST, respond with that university name
-    2. If no university is mentioned and user intends to continue about {state['university_name']}, respond with {state['university_name']}
-    3. If user mentions multiple universities, respond with GENERAL
-    4. If user mentions another university (not NUST/COMSATS/FAST), respond with that university name
-    5. Otherwise respond with GENERAL
-
-    Examples:
-    - "what is the fee structure of this university?" → {state['university_name']}
-    - "which university has the best CS program?" → GENERAL
-    - "tell me about bahria university" → BAHRIA
-
-    User query: "{query_for_prompt}"
+    # Specific, unambiguous first-pass queries skip the LLM entirely (retries always rewrite)
+    is_retry = state.get("quality_passed") is False
+    if not is_retry and keyword_uni is not None and not needs_rewrite(state['user_query']):
+        return {"rewritten_query": state['user_query'], "university_name": keyword_uni}
     
-    Respond with ONLY the university name or GENERAL:"""
+    prompt = REWRITE_AND_ROUTE_TMPL.substitute(
+        uni=uni_display_name, current_uni=current_uni, query=state['user_query']
+    )
     
-    resp = llm.invoke(prompt)
-    uni = resp.content.strip().upper()
+    try:
+        result = await get_rewrite_router().ainvoke(prompt)
+        rewritten_query = (result.get("rewritten") or "").replace('**', '').replace('*', '').strip()
+        uni = (result.get("university") or current_uni).strip().upper()
+    except Exception as e:
+        rewritten_query, uni = "", current_uni.upper()
+    
+    # Explicit mentions are deterministic; the LLM's choice only matters for follow-ups
+    if keyword_uni is not None:
+        uni = keyword_uni
+    
+    if not rewritten_query or len(rewritten_query) < 5:
+        rewritten_query = state['user_query']
     
     # Normalize known universities
     if "NUST" in uni:
@@ -180,15 +538,22 @@ def supervisor_node(state: State):
     elif "COMSATS" in uni:
         uni = "COMSATS"
     
-    return {"university_name": uni}
+    return {"rewritten_query": rewritten_query, "university_name": uni}
 
 def create_university_agent(university_name: str, vector_dbs: dict):
     """Factory function to create university-specific agents"""
-    def agent(state: State):
-        db = vector_dbs[university_name.upper()]
-        query = state.get("rewritten_query") or state["user_query"]
-        rag_chain = create_rag_chain(db, university_name.lower())
-        answer = rag_chain(query)
+    # The chain is pure per-university state, build it once instead of per query
+    rag_chain = create_rag_chain(vector_dbs[university_name.upper()], university_name.lower())
+    
+    async def agent(state: State):
+        query = effective_query(state)
+        # On a retry, reuse what the failed attempt retrieved alongside the fresh results
+        is_retry = state.get("quality_passed") is False
+        # Unique per attempt, so concurrent sessions asking the same question never share a staged answer
+        cache_token = uuid.uuid4().hex
+        answer, doc_ids = await rag_chain(
+            query, cache_token, state.get("last_doc_ids") if is_retry else None, retry=is_retry
+        )
         
         new_entry = {
             "university": university_name.upper(),
@@ -198,32 +563,22 @@ def create_university_agent(university_name: str, vector_dbs: dict):
         
         return {
             "answer": answer,
+            "last_doc_ids": doc_ids,
+            "cache_token": cache_token,
             "conversation_history": [new_entry]
         }
     
     return agent
 
-def general_agent(state: State):
+async def general_agent(state: State):
     """General purpose agent without university-specific context"""
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0.2,
-        max_tokens=None,
-        timeout=None,
-        max_retries=2
-    )
+    llm = get_llm("flash25")
     
-    query = state.get("rewritten_query") or state["user_query"]
+    query = effective_query(state)
     
-    prompt = f"""You are a knowledgeable assistant for university students. Answer the user's question directly, clearly and concisely.
-    If user mentions a specific university, provide relevant information about that university.
-    If user does not mention any university and intends to continue about {state['university_name']}, provide information about {state['university_name']} university.
-
-    Question: {query}
-
-    Answer:"""
+    prompt = GENERAL_TMPL.substitute(uni=state['university_name'], query=query)
     
-    response = llm.invoke(prompt)
+    response = await llm.ainvoke(prompt)
     answer = response.content.strip() if hasattr(response, "content") else str(response).strip()
     
     new_entry = {
@@ -234,33 +589,31 @@ def general_agent(state: State):
     
     return {
         "answer": answer,
+        "cache_token": "",
         "conversation_history": [new_entry]
     }
 
-def quality_checker_node(state: State):
+async def quality_checker_node(state: State):
     """Evaluates answer quality and decides if rewriting is needed"""
-    llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0)
+    query = effective_query(state)
     
-    query = state.get("rewritten_query") or state["user_query"]
+    # Local cross-encoder relevance score; only borderline answers cost an LLM call
+    score = await asyncio.to_thread(lambda: float(RERANKER.predict([(query, state['answer'])])[0]))
     
-    prompt = f"""You are a quality evaluator. Rate the following answer based on:
-1. Relevance to the question
-2. Completeness
-3. Clarity
-
-Note: if the answer contains information related to query, even if minimal, it should be considered relevant and reply with YES.
-
-Question: {query}
-Answer: {state['answer']}
-
-Respond with ONLY one word: YES or NO."""
+    if abs(score - QUALITY_SCORE_THRESHOLD) >= QUALITY_SCORE_MARGIN:
+        passed = score > QUALITY_SCORE_THRESHOLD
+    else:
+        llm = get_llm("flash20")
+        prompt = QUALITY_TMPL.substitute(query=query, answer=state['answer'])
+        response = (await llm.ainvoke(prompt)).content.strip().upper()
+        passed = "YES" in response
     
-    response = llm.invoke(prompt).content.strip().upper()
+    # Only answers that passed are kept in the university's semantic cache
+    semantic_cache = SEMANTIC_CACHES.get(state.get("university_name", "").upper())
+    if semantic_cache is not None and state.get("cache_token"):
+        semantic_cache.resolve(state["cache_token"], passed)
     
-    if "YES" in response:
-        return {"quality_passed": True, "rewritten_query": ""}
-    else:
-        return {"quality_passed": False, "rewritten_query": ""}
+    return {"quality_passed": passed, "rewritten_query": ""}
 
 def printer_node(state: State):
     """Final node - passes state through"""
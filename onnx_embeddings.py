@@ -0,0 +1,76 @@
+"""
+onnx_embeddings.py
+Int8-quantized ONNX Runtime version of all-MiniLM-L6-v2
+Shared by ingestion (extract_data.py) and retrieval (helper_functions.py) so both embed identically
+"""
+
+import os
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# ==================== CONFIGURATION ====================
+# Set EMBEDDINGS_BACKEND=onnx to embed with the quantized model instead of PyTorch.
+# Vector DBs must be rebuilt with the same backend they are queried with.
+USE_ONNX_EMBEDDINGS = os.getenv("EMBEDDINGS_BACKEND", "hf").lower() == "onnx"
+ONNX_MODEL_DIR = "./onnx_models"
+QUANTIZED_FILE = "model_quantized.onnx"
+MAX_SEQ_LENGTH = 256
+# e.g. OpenVINOExecutionProvider on Intel CPUs, if onnxruntime-openvino is installed
+ONNX_PROVIDER = os.getenv("ONNX_PROVIDER", "CPUExecutionProvider")
+
+# ==================== EMBEDDINGS ====================
+class OnnxMiniLMEmbeddings(Embeddings):
+    """Mean-pooled, L2-normalized sentence embeddings from an int8 ONNX model"""
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", batch_size=64):
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError as e:
+            raise ImportError(
+                'EMBEDDINGS_BACKEND=onnx needs the optional ONNX dependencies: pip install "optimum[onnxruntime]"'
+            ) from e
+        from transformers import AutoTokenizer
+
+        self.batch_size = batch_size
+        model_dir = os.path.join(ONNX_MODEL_DIR, model_name.split("/")[-1] + "-int8")
+
+        # Export + quantize once, then reuse the files on disk
+        if not os.path.exists(os.path.join(model_dir, QUANTIZED_FILE)):
+            print(f"🔄 Exporting {model_name} to int8 ONNX...")
+            model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            model.save_pretrained(model_dir)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=QUANTIZED_FILE, provider=ONNX_PROVIDER
+        )
+
+    def _embed(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(
+                texts[i:i + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors="np",
+            )
+            token_embeddings = np.asarray(self.model(**batch).last_hidden_state)
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled)
+        if not vectors:
+            return []
+        return np.concatenate(vectors).tolist()
+
+    def embed_documents(self, texts):
+        return self._embed(list(texts))
+
+    def embed_query(self, text):
+        return self._embed([text])[0]
@@ -0,0 +1,61 @@
+"""
+sqlite_docstore.py
+Read-only, lazily loaded docstore for the saved FAISS vector DBs
+Written by ingestion (extract_data.py) next to index.faiss and read by retrieval (helper_functions.py),
+so the app looks chunks up on demand instead of unpickling every one of them into memory
+"""
+
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+DOCSTORE_FILE = "docstore.sqlite"
+# Let SQLite read the file through the OS page cache, shared across worker processes
+DOCSTORE_MMAP_SIZE = 256 * 1024 * 1024
+
+def write_sqlite_docstore(path, vector_db):
+    """Writes every Document of a FAISS vector store, keyed by index position, to a fresh sqlite file"""
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE docs (pos INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, "
+            "page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?)", (
+            (pos, doc_id, doc.page_content, json.dumps(doc.metadata))
+            for pos, doc_id in vector_db.index_to_docstore_id.items()
+            for doc in [vector_db.docstore.search(doc_id)]
+        ))
+    conn.close()
+    os.replace(tmp_path, path)
+
+class SqliteDocstore(Docstore):
+    """Docstore over a read-only sqlite file; Documents are built on each lookup"""
+
+    def __init__(self, path):
+        uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+        # One shared read-only connection; lookups come from the loop thread and worker threads
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.conn.execute(f"PRAGMA mmap_size = {DOCSTORE_MMAP_SIZE}")
+        self.lock = threading.Lock()
+
+    def search(self, search):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT page_content, metadata FROM docs WHERE id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def index_to_docstore_id(self):
+        """FAISS index position -> docstore id, as FAISS.__init__ expects it"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT pos, id FROM docs"))